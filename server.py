@@ -1,71 +1,398 @@
-import asyncio
-import websockets
-import json
-import logging
-import os
-from datetime import datetime
-
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-async def handle_connection(websocket, path):
-    """Simple WebSocket handler for testing"""
-    logger.info(f"New connection established at {datetime.now()}")
-    
-    try:
-        # Send initial test message
-        initial_message = {
-            "status": "connected",
-            "message": "WebSocket server is working!",
-            "timestamp": datetime.now().isoformat()
-        }
-        await websocket.send(json.dumps(initial_message))
-        logger.info("Sent initial test message")
-        
-        # Listen for messages
-        async for message in websocket:
-            logger.info(f"Received: {message}")
-            
-            # Echo back the message
-            response = {
-                "echo": message,
-                "timestamp": datetime.now().isoformat()
-            }
-            await websocket.send(json.dumps(response))
-            
-    except websockets.exceptions.ConnectionClosed:
-        logger.info("Connection closed")
-    except Exception as e:
-        logger.error(f"Error: {e}")
-
-async def main():
-    """Main server function"""
-    host = "0.0.0.0"
-    port = int(os.getenv("PORT", 8080))
-    
-    logger.info(f"Starting test WebSocket server on {host}:{port}")
-    
-    # Start the WebSocket server
-    server = await websockets.serve(
-        handle_connection,
-        host,
-        port,
-        ping_interval=30,
-        ping_timeout=10
-    )
-    
-    logger.info("WebSocket server started successfully")
-    logger.info(f"Server listening on ws://{host}:{port}")
-    
-    # Keep the server running
-    await server.wait_closed()
-
-if __name__ == "__main__":
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        logger.info("Server shutdown requested")
-    except Exception as e:
-        logger.error(f"Server error: {e}")
-    
+import asyncio
+import hashlib
+import logging
+import os
+import socket
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import websockets
+
+try:
+    import orjson
+
+    # orjson.dumps returns bytes, which websockets sends without the
+    # str -> bytes encode step json.dumps would require
+    json_dumps = orjson.dumps
+except ImportError:
+    import json
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
+import msgspec
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+import httpx
+from dotenv import load_dotenv
+from mistralai.async_client import MistralAsyncClient
+
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MISTRAL_MODEL = os.getenv("MISTRAL_MODEL", "mistral-small-latest")
+
+# Bounds on cached conversation state: calls are evicted LRU beyond
+# MAX_CALLS, and each call keeps at most MAX_TURNS messages after the
+# system prompt
+MAX_CALLS = 10000
+MAX_TURNS = 64
+
+SYSTEM_PROMPT = (
+    "You are a helpful voice assistant. Keep your responses short and "
+    "conversational, as they will be spoken aloud to the caller. Do not "
+    "use markdown, lists, or other formatting that does not read naturally."
+)
+
+
+class TranscriptEntry(msgspec.Struct):
+    """One utterance in the Retell transcript"""
+    role: str = ""
+    content: str = ""
+
+
+class RetellFrame(msgspec.Struct):
+    """Inbound Retell frame, decoded straight into a fixed layout"""
+    interaction_type: str = ""
+    response_id: int = 0
+    transcript: list[TranscriptEntry] = []
+    timestamp: int = 0
+
+
+class ResponseFrame(msgspec.Struct):
+    """Outbound agent response frame"""
+    response_type: str
+    response_id: int
+    content: str
+    content_complete: bool
+    end_call: bool
+
+
+_decode_frame = msgspec.json.Decoder(RetellFrame).decode
+_encode_frame = msgspec.json.Encoder().encode
+
+ERROR_MESSAGE = (
+    "I'm sorry, I'm having trouble responding right now. "
+    "Could you say that again?"
+)
+
+# The greeting never changes (response_id is always 0 on connect), so
+# encode it once instead of rebuilding the frame per connection
+GREETING_BYTES = _encode_frame(ResponseFrame(
+    response_type="response",
+    response_id=0,
+    content="Hello! How can I help you today?",
+    content_complete=True,
+    end_call=False,
+))
+
+
+def _call_socket(websocket):
+    """Raw socket behind a websocket connection, or None"""
+    transport = getattr(websocket, "transport", None)
+    return transport.get_extra_info("socket") if transport else None
+
+
+@contextmanager
+def corked(sock):
+    """Coalesce a burst of small writes into one TCP segment (Linux only)"""
+    cork = getattr(socket, "TCP_CORK", None)
+    if sock is None or cork is None:
+        yield
+        return
+    sock.setsockopt(socket.IPPROTO_TCP, cork, 1)
+    try:
+        yield
+    finally:
+        sock.setsockopt(socket.IPPROTO_TCP, cork, 0)
+
+
+class RetellMistralServer:
+    """WebSocket server bridging Retell AI calls to the Mistral API."""
+
+    def __init__(self):
+        api_key = os.getenv("MISTRAL_API_KEY")
+        if not api_key:
+            raise ValueError("MISTRAL_API_KEY environment variable is not set")
+        self.mistral_client = MistralAsyncClient(api_key=api_key)
+        # Share one pooled HTTP/2 connection across all in-flight turns so
+        # TLS handshakes are amortized and concurrent calls multiplex over
+        # a single TCP connection. The v0 SDK exposes no http_client
+        # parameter, so its internal client is swapped out directly.
+        self.http_client = httpx.AsyncClient(
+            http2=True,
+            follow_redirects=True,
+            timeout=getattr(self.mistral_client, "_timeout", 120),
+            limits=httpx.Limits(max_keepalive_connections=100),
+        )
+        self.mistral_client._client = self.http_client
+        self.conversations = OrderedDict()
+
+    async def close(self):
+        """Release the pooled Mistral HTTP connections"""
+        await self.http_client.aclose()
+
+    async def handle_connection(self, websocket, path):
+        """Handle a new Retell call connection"""
+        call_id = path.rstrip("/").split("/")[-1] or "unknown"
+        logger.info("New Retell connection for call %s", call_id)
+
+        # Retell frames are tiny and latency-bound; Nagle's algorithm
+        # would hold them back up to 40ms waiting for a full segment
+        sock = _call_socket(websocket)
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        try:
+            # Greet the caller as soon as the call connects
+            with corked(sock):
+                await websocket.send(GREETING_BYTES)
+
+            async for message in websocket:
+                await self.process_message(websocket, call_id, message)
+
+        except websockets.exceptions.ConnectionClosed:
+            logger.info("Connection closed for call %s", call_id)
+        except Exception as e:
+            logger.error("Error handling call %s: %s", call_id, e)
+        finally:
+            self.conversations.pop(call_id, None)
+
+    async def process_message(self, websocket, call_id, message):
+        """Dispatch an inbound Retell frame by interaction type"""
+        # Decoding straight into the fixed-layout struct skips the dict
+        # build and per-key string hashing of a generic JSON parse
+        frame = _decode_frame(message)
+        # Deferred %-formatting plus the level gate keeps the growing
+        # transcript out of the log line and skips formatting entirely
+        # when INFO is disabled
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Received %s frame", frame.interaction_type)
+
+        interaction_type = frame.interaction_type
+
+        if interaction_type == "ping_pong":
+            pong = {
+                "response_type": "ping_pong",
+                "timestamp": frame.timestamp,
+            }
+            await websocket.send(json_dumps(pong))
+        elif interaction_type == "call_details":
+            logger.info("Call details received for %s", call_id)
+        elif interaction_type == "update_only":
+            # Retell sends these per word of live transcript; returning
+            # here instead of awaiting a do-nothing handler skips a
+            # coroutine allocation and scheduler round-trip per update
+            logger.debug("Transcript update received")
+            return
+        elif interaction_type in ("response_required", "reminder_required"):
+            await self.handle_response_required(websocket, call_id, frame)
+
+    async def handle_response_required(self, websocket, call_id, frame):
+        """Generate an agent response and stream it back to Retell"""
+        response_id = frame.response_id
+        transcript = frame.transcript
+
+        # reversed() on a list is a plain iterator, so this stops at the
+        # first user entry without copying or scanning the whole transcript
+        user_message = next(
+            (e.content for e in reversed(transcript) if e.role == "user"),
+            "",
+        )
+
+        state = self.prepare_conversation_context(call_id, transcript)
+
+        # Retell retries a turn with the same transcript if it misses our
+        # response; replay the memoized answer instead of regenerating it
+        cache_key = (state["prefix_hash"], user_message)
+        cached = state.get("last_response")
+        if cached is not None and cached[0] == cache_key:
+            await websocket.send(_encode_frame(ResponseFrame(
+                response_type="response",
+                response_id=response_id,
+                content=cached[1],
+                content_complete=True,
+                end_call=False,
+            )))
+            return
+
+        # Every streamed delta shares the same envelope, differing only in
+        # content; build the envelope bytes once per response and splice
+        # each (JSON-escaped) delta in, instead of encoding a full frame
+        # per token
+        delta_prefix = (
+            b'{"response_type":"response","response_id":'
+            + str(response_id).encode()
+            + b',"content":'
+        )
+        delta_suffix = b',"content_complete":false,"end_call":false}'
+
+        # Each frame send is scheduled as a task rather than awaited
+        # serially, so socket writes overlap with reading the next chunk
+        # from Mistral and the turn settles them in a single gather
+        # instead of paying an await round-trip per frame
+        sends = []
+        try:
+            # Forward token deltas to Retell as they arrive so speech
+            # synthesis can start before the full response is generated
+            chunks = []
+            async for delta in self.call_mistral_model(state["roles"], state["contents"]):
+                chunks.append(delta)
+                sends.append(asyncio.ensure_future(
+                    websocket.send(delta_prefix + json_dumps(delta) + delta_suffix)
+                ))
+
+            sends.append(asyncio.ensure_future(websocket.send(_encode_frame(ResponseFrame(
+                response_type="response",
+                response_id=response_id,
+                content="",
+                content_complete=True,
+                end_call=False,
+            )))))
+            await asyncio.gather(*sends)
+            state["last_response"] = (cache_key, "".join(chunks))
+        except Exception as e:
+            logger.error("Error generating response for call %s: %s", call_id, e)
+            for send in sends:
+                send.cancel()
+            await websocket.send(_encode_frame(ResponseFrame(
+                response_type="response",
+                response_id=response_id,
+                content=ERROR_MESSAGE,
+                content_complete=True,
+                end_call=False,
+            )))
+
+    def prepare_conversation_context(self, call_id, transcript):
+        """Extend the cached conversation state with new transcript entries"""
+        state = self.conversations.get(call_id)
+        if state is None:
+            # Roles and contents live in parallel arrays; the message
+            # dicts the SDK wants are only materialized at the call
+            # boundary, halving per-entry allocations on this path
+            state = {
+                "roles": ["system"],
+                "contents": [SYSTEM_PROMPT],
+                "len": 0,
+            }
+            self.conversations[call_id] = state
+            # Disconnects normally evict their entry, but a dropped
+            # cleanup must not leak memory forever
+            if len(self.conversations) > MAX_CALLS:
+                self.conversations.popitem(last=False)
+        else:
+            self.conversations.move_to_end(call_id)
+
+        # Only the entries added since the last turn need converting;
+        # rebuilding the whole list every turn is O(N^2) over a call
+        roles = state["roles"]
+        contents = state["contents"]
+        for entry in transcript[state["len"]:]:
+            if entry.role == "agent":
+                roles.append("assistant")
+                contents.append(entry.content)
+            elif entry.role == "user":
+                roles.append("user")
+                contents.append(entry.content)
+        state["len"] = len(transcript)
+
+        # Keep the context window bounded on marathon calls: drop the
+        # oldest turns but never the system prompt at index 0
+        if len(roles) > MAX_TURNS + 1:
+            cut = len(roles) - MAX_TURNS
+            del roles[1:cut]
+            del contents[1:cut]
+
+        # Fingerprint the prompt prefix (everything before the latest
+        # message) so retried turns with an identical prefix can be
+        # recognised instead of re-paying Mistral prefill for them
+        state["prefix_hash"] = hashlib.blake2b(
+            b"\n".join(c.encode() for c in contents[:-1]),
+            digest_size=16,
+        ).digest()
+
+        return state
+
+    async def call_mistral_model(self, roles, contents):
+        """Stream a completion from Mistral, yielding token deltas"""
+        async for chunk in self.mistral_client.chat_stream(
+            model=MISTRAL_MODEL,
+            messages=[{"role": r, "content": c} for r, c in zip(roles, contents)],
+            max_tokens=500,
+            temperature=0.7,
+        ):
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
+
+def _listen_socket(host, port):
+    """Listening socket with SO_REUSEPORT so workers can share the port"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+async def main():
+    """Main server function"""
+    host = "0.0.0.0"
+    port = int(os.getenv("PORT", 8080))
+
+    retell_server = RetellMistralServer()
+
+    logger.info("Starting Retell Mistral server on %s:%s (pid %s)", host, port, os.getpid())
+
+    # Retell frames are small, frequent JSON: permessage-deflate is pure
+    # zlib overhead on them, and the default 1MB limits are far larger
+    # than any frame we exchange
+    server = await websockets.serve(
+        retell_server.handle_connection,
+        sock=_listen_socket(host, port),
+        ping_interval=30,
+        ping_timeout=10,
+        compression=None,
+        max_size=65536,
+        max_queue=32,
+        read_limit=2 ** 16,
+        write_limit=2 ** 16
+    )
+
+    logger.info("WebSocket server started successfully")
+    logger.info("Server listening on ws://%s:%s", host, port)
+
+    # Keep the server running
+    try:
+        await server.wait_closed()
+    finally:
+        await retell_server.close()
+
+if __name__ == "__main__":
+    try:
+        # A single asyncio process saturates one core on JSON parsing and
+        # frame handling; with SO_REUSEPORT each forked worker binds the
+        # same port and the kernel balances accepts across them
+        workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+        if workers > 1 and hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT"):
+            for _ in range(workers - 1):
+                if os.fork() == 0:
+                    break
+
+        # uvloop's libuv-based loop handles socket readiness in C,
+        # roughly 2-4x faster than the default loop for websocket traffic
+        if uvloop is not None:
+            uvloop.install()
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("Server shutdown requested")
+    except Exception as e:
+        logger.error("Server error: %s", e)